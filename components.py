@@ -11,6 +11,7 @@ from gdshelpers.parts.resonator import RingResonator
 from gdshelpers.parts.optical_codes import QRCode
 
 from parameters import *
+from polygon_store import CompactCell
 
 # Do not delete or change!
 # TODO: Find a less hacky fix SC 01/02/22
@@ -51,9 +52,9 @@ class CornerstoneGratingCoupler:
                                                            extra_triangle_layer=True,
                                                            **coupler_params)
         global CORNERSTONE_GRATING_IDENTIFIER
-        cell = Cell("GC_period_{}_coords_{}_{}_{}".format(coupler_params['grating_period'],
-                                                          origin[0],
-                                                          origin[1], CORNERSTONE_GRATING_IDENTIFIER))
+        cell = CompactCell("GC_period_{}_coords_{}_{}_{}".format(coupler_params['grating_period'],
+                                                                 origin[0],
+                                                                 origin[1], CORNERSTONE_GRATING_IDENTIFIER))
         CORNERSTONE_GRATING_IDENTIFIER += 1
 
         # add outline to draw layer
@@ -114,6 +115,65 @@ def grating_checker(gratings):
     return x_diff, y_diff
 
 
+def ring_bus_waveguide(port):
+    """
+    Bus waveguide of the ring resonator devices, from the left
+    grating at `port` round to where the right grating goes.
+    :param port: Port of the left grating
+    :return: Waveguide, port at which the ring is placed
+    """
+    wg = Waveguide.make_at_port(port=port)
+    wg.add_straight_segment(length=200)
+    wg.add_bend(angle=- pi / 2, radius=BEND_RADIUS).add_straight_segment(length=127 / 2 - 10)
+    ring_port = wg.current_port
+    wg.add_straight_segment(length=127 / 2 - 10).add_bend(angle=- pi / 2, radius=BEND_RADIUS)
+    wg.add_straight_segment(length=200)
+
+    return wg, ring_port
+
+
+def mzi_input_waveguide(port):
+    """
+    Waveguide from the left grating at `port` to the input of an MZI.
+    :param port: Port of the left grating
+    :return: Waveguide, its current port is the MZI input
+    """
+    wg = Waveguide.make_at_port(port=port)
+    wg.add_straight_segment(length=200)
+    wg.add_bend(angle=- pi / 2, radius=BEND_RADIUS).add_straight_segment(length=19)
+
+    return wg
+
+
+def mzi_output_waveguide(port):
+    """
+    Waveguide from the output of an MZI at `port` to where the right grating goes.
+    :param port: Output port of the MZI
+    :return: Waveguide
+    """
+    wg = Waveguide.make_at_port(port=port)
+    wg.add_straight_segment(length=19).add_bend(angle=- pi / 2, radius=BEND_RADIUS)
+    wg.add_straight_segment(length=200)
+
+    return wg
+
+
+def loopback_waveguide(port, length):
+    """
+    Plain waveguide from the left grating at `port` to where the right grating goes.
+    :param port: Port of the left grating
+    :param length: Length of the straight between the two bends, sets the grating separation
+    :return: Waveguide
+    """
+    wg = Waveguide.make_at_port(port=port)
+    wg.add_straight_segment(length=100)
+    wg.add_straight_segment(length=200).add_bend(angle=- pi / 2, radius=BEND_RADIUS)
+    wg.add_straight_segment(length=length).add_bend(angle=- pi / 2, radius=BEND_RADIUS)
+    wg.add_straight_segment(length=200).add_straight_segment(length=100)
+
+    return wg
+
+
 def grating_loopback(coupler_params, position=(0, 0), name='GRATING_LOOPBACK'):
     """
     Function which returns a cell containing
@@ -124,7 +184,7 @@ def grating_loopback(coupler_params, position=(0, 0), name='GRATING_LOOPBACK'):
     :return: Cell containing the loopback
     """
 
-    grating_loopback_cell = Cell(name)
+    grating_loopback_cell = CompactCell(name)
 
     # Create the cell that we are going to add to
 
@@ -205,12 +265,8 @@ def grating_loopback(coupler_params, position=(0, 0), name='GRATING_LOOPBACK'):
         origin=(position[0], position[1]),
         coupler_params=coupler_params)
     grating_loopback_cell.add_cell(left_grating_d4.cell)
-    wg_d4_1 = Waveguide.make_at_port(port=left_grating_d4.port)
-    wg_d4_1.add_straight_segment(length=200)
-    wg_d4_1.add_bend(angle=- pi / 2, radius=BEND_RADIUS).add_straight_segment(length=127/2 - 10)
-    resonator_1 = RingResonator.make_at_port(wg_d4_1.current_port, gap=1, radius=20)
-    wg_d4_1.add_straight_segment(length=127 / 2 -10).add_bend(angle=- pi / 2, radius=BEND_RADIUS)
-    wg_d4_1.add_straight_segment(length=200)
+    wg_d4_1, ring_port_d4 = ring_bus_waveguide(left_grating_d4.port)
+    resonator_1 = RingResonator.make_at_port(ring_port_d4, gap=1, radius=20)
 
     right_grating_d4 = CornerstoneGratingCoupler().create_cornerstone_coupler_at_port(
         port=wg_d4_1.current_port,
@@ -224,12 +280,8 @@ def grating_loopback(coupler_params, position=(0, 0), name='GRATING_LOOPBACK'):
         origin=(position[0], position[1]),
         coupler_params=coupler_params)
     grating_loopback_cell.add_cell(left_grating_d5.cell)
-    wg_d5_1 = Waveguide.make_at_port(port=left_grating_d5.port)
-    wg_d5_1.add_straight_segment(length=200)
-    wg_d5_1.add_bend(angle=- pi / 2, radius=BEND_RADIUS).add_straight_segment(length=127 / 2 - 10)
-    resonator_2 = RingResonator.make_at_port(wg_d5_1.current_port, gap=1, radius=35)
-    wg_d5_1.add_straight_segment(length=127 / 2 - 10).add_bend(angle=- pi / 2, radius=BEND_RADIUS)
-    wg_d5_1.add_straight_segment(length=200)
+    wg_d5_1, ring_port_d5 = ring_bus_waveguide(left_grating_d5.port)
+    resonator_2 = RingResonator.make_at_port(ring_port_d5, gap=1, radius=35)
 
     right_grating_d5 = CornerstoneGratingCoupler().create_cornerstone_coupler_at_port(
         port=wg_d5_1.current_port,
@@ -243,12 +295,8 @@ def grating_loopback(coupler_params, position=(0, 0), name='GRATING_LOOPBACK'):
         origin=(position[0], position[1]),
         coupler_params=coupler_params)
     grating_loopback_cell.add_cell(left_grating_d6.cell)
-    wg_d6_1 = Waveguide.make_at_port(port=left_grating_d6.port)
-    wg_d6_1.add_straight_segment(length=200)
-    wg_d6_1.add_bend(angle=- pi / 2, radius=BEND_RADIUS).add_straight_segment(length=127 / 2 - 10)
-    resonator_3 = RingResonator.make_at_port(wg_d6_1.current_port, gap=1, radius=50)
-    wg_d6_1.add_straight_segment(length=127 / 2 - 10).add_bend(angle=- pi / 2, radius=BEND_RADIUS)
-    wg_d6_1.add_straight_segment(length=200)
+    wg_d6_1, ring_port_d6 = ring_bus_waveguide(left_grating_d6.port)
+    resonator_3 = RingResonator.make_at_port(ring_port_d6, gap=1, radius=50)
 
     right_grating_d6 = CornerstoneGratingCoupler().create_cornerstone_coupler_at_port(
         port=wg_d6_1.current_port,
@@ -262,17 +310,12 @@ def grating_loopback(coupler_params, position=(0, 0), name='GRATING_LOOPBACK'):
         origin=(position[0], position[1]),
         coupler_params=coupler_params)
     grating_loopback_cell.add_cell(left_grating_d7.cell)
-    wg_d7_1 = Waveguide.make_at_port(port=left_grating_d7.port)
-    wg_d7_1.add_straight_segment(length=200)
-    wg_d7_1.add_bend(angle=- pi / 2, radius=BEND_RADIUS).add_straight_segment(length=19)
+    wg_d7_1 = mzi_input_waveguide(left_grating_d7.port)
     mzi_1 = MachZehnderInterferometerMMI.make_at_port(port=wg_d7_1.current_port, splitter_length=33, splitter_width=7,
                                                       bend_radius=20, upper_vertical_length=50,
                                                       lower_vertical_length=100,
                                                       horizontal_length=30)
-    wg_d7_2 = Waveguide.make_at_port(port=mzi_1.port)
-
-    wg_d7_2.add_straight_segment(length=19).add_bend(angle=- pi / 2, radius=BEND_RADIUS)
-    wg_d7_2.add_straight_segment(length=200)
+    wg_d7_2 = mzi_output_waveguide(mzi_1.port)
 
     right_grating_d7 = CornerstoneGratingCoupler().create_cornerstone_coupler_at_port(
         port=wg_d7_2.current_port,
@@ -286,17 +329,12 @@ def grating_loopback(coupler_params, position=(0, 0), name='GRATING_LOOPBACK'):
         origin=(position[0], position[1]),
         coupler_params=coupler_params)
     grating_loopback_cell.add_cell(left_grating_d8.cell)
-    wg_d8_1 = Waveguide.make_at_port(port=left_grating_d8.port)
-    wg_d8_1.add_straight_segment(length=200)
-    wg_d8_1.add_bend(angle=- pi / 2, radius=BEND_RADIUS).add_straight_segment(length=19)
+    wg_d8_1 = mzi_input_waveguide(left_grating_d8.port)
     mzi_2 = MachZehnderInterferometerMMI.make_at_port(port=wg_d8_1.current_port, splitter_length=33, splitter_width=7,
                                                       bend_radius=20, upper_vertical_length=100,
                                                       lower_vertical_length=100,
                                                       horizontal_length=30)
-    wg_d8_2 = Waveguide.make_at_port(port=mzi_2.port)
-
-    wg_d8_2.add_straight_segment(length=19).add_bend(angle=- pi / 2, radius=BEND_RADIUS)
-    wg_d8_2.add_straight_segment(length=200)
+    wg_d8_2 = mzi_output_waveguide(mzi_2.port)
 
     right_grating_d8 = CornerstoneGratingCoupler().create_cornerstone_coupler_at_port(
         port=wg_d8_2.current_port,
@@ -310,17 +348,12 @@ def grating_loopback(coupler_params, position=(0, 0), name='GRATING_LOOPBACK'):
         origin=(position[0], position[1]),
         coupler_params=coupler_params)
     grating_loopback_cell.add_cell(left_grating_d9.cell)
-    wg_d9_1 = Waveguide.make_at_port(port=left_grating_d9.port)
-    wg_d9_1.add_straight_segment(length=200)
-    wg_d9_1.add_bend(angle=- pi / 2, radius=BEND_RADIUS).add_straight_segment(length=19)
+    wg_d9_1 = mzi_input_waveguide(left_grating_d9.port)
     mzi_3 = MachZehnderInterferometerMMI.make_at_port(port=wg_d9_1.current_port, splitter_length=33, splitter_width=7,
                                                       bend_radius=20, upper_vertical_length=150,
                                                       lower_vertical_length=100,
                                                       horizontal_length=30)
-    wg_d9_2 = Waveguide.make_at_port(port=mzi_3.port)
-
-    wg_d9_2.add_straight_segment(length=19).add_bend(angle=- pi / 2, radius=BEND_RADIUS)
-    wg_d9_2.add_straight_segment(length=200)
+    wg_d9_2 = mzi_output_waveguide(mzi_3.port)
 
     right_grating_d9 = CornerstoneGratingCoupler().create_cornerstone_coupler_at_port(
         port=wg_d9_2.current_port,
@@ -334,11 +367,7 @@ def grating_loopback(coupler_params, position=(0, 0), name='GRATING_LOOPBACK'):
         origin=(position[0], position[1]),
         coupler_params=coupler_params)
     grating_loopback_cell.add_cell(left_grating_d10.cell)
-    wg_d10_1 = Waveguide.make_at_port(port=left_grating_d10.port)
-    wg_d10_1.add_straight_segment(length=100)
-    wg_d10_1.add_straight_segment(length=200).add_bend(angle=- pi / 2, radius=BEND_RADIUS)
-    wg_d10_1.add_straight_segment(length=127-10-10).add_bend(angle=- pi / 2, radius=BEND_RADIUS)
-    wg_d10_1.add_straight_segment(length=200).add_straight_segment(length=100)
+    wg_d10_1 = loopback_waveguide(left_grating_d10.port, length=127-10-10)
     grating_loopback_cell.add_to_layer(WAVEGUIDE_LAYER, wg_d10_1)
     right_grating_d10 = CornerstoneGratingCoupler().create_cornerstone_coupler_at_port(
         port=wg_d10_1.current_port,
@@ -351,11 +380,7 @@ def grating_loopback(coupler_params, position=(0, 0), name='GRATING_LOOPBACK'):
         origin=(position[0], position[1]),
         coupler_params=coupler_params)
     grating_loopback_cell.add_cell(left_grating_d11.cell)
-    wg_d11_1 = Waveguide.make_at_port(port=left_grating_d11.port)
-    wg_d11_1.add_straight_segment(length=100)
-    wg_d11_1.add_straight_segment(length=200).add_bend(angle=- pi / 2, radius=BEND_RADIUS)
-    wg_d11_1.add_straight_segment(length=127 - 10 + 127 - 10).add_bend(angle=- pi / 2, radius=BEND_RADIUS)
-    wg_d11_1.add_straight_segment(length=200).add_straight_segment(length=100)
+    wg_d11_1 = loopback_waveguide(left_grating_d11.port, length=127 - 10 + 127 - 10)
     grating_loopback_cell.add_to_layer(WAVEGUIDE_LAYER, wg_d11_1)
     right_grating_d11 = CornerstoneGratingCoupler().create_cornerstone_coupler_at_port(
         port=wg_d11_1.current_port,
@@ -368,11 +393,7 @@ def grating_loopback(coupler_params, position=(0, 0), name='GRATING_LOOPBACK'):
         origin=(position[0], position[1]),
         coupler_params=coupler_params)
     grating_loopback_cell.add_cell(left_grating_d12.cell)
-    wg_d12_1 = Waveguide.make_at_port(port=left_grating_d12.port)
-    wg_d12_1.add_straight_segment(length=100)
-    wg_d12_1.add_straight_segment(length=200).add_bend(angle=- pi / 2, radius=BEND_RADIUS)
-    wg_d12_1.add_straight_segment(length=127 - 10 + 127 + 127 -10).add_bend(angle=- pi / 2, radius=BEND_RADIUS)
-    wg_d12_1.add_straight_segment(length=200).add_straight_segment(length=100)
+    wg_d12_1 = loopback_waveguide(left_grating_d12.port, length=127 - 10 + 127 + 127 -10)
     grating_loopback_cell.add_to_layer(WAVEGUIDE_LAYER, wg_d12_1)
     right_grating_d12 = CornerstoneGratingCoupler().create_cornerstone_coupler_at_port(
         port=wg_d12_1.current_port,
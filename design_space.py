@@ -8,6 +8,7 @@ from gdshelpers.layout import GridLayout
 
 from components import *
 from parameters import *
+from polygon_store import save_gds
 
 # Path where you want your GDS to be saved to
 savepath = r"./"
@@ -90,7 +91,8 @@ def populate_gds(layout_cell, polygon):
     design_space_cell.add_to_layer(99, polygon)
 
     # Save our GDS
-    design_space_cell.save('{0}Nanofab_Yu-Kun_Feng_design.gds'.format(savepath))
+    # CompactCells are written straight from their coordinate arrays
+    save_gds(design_space_cell, '{0}Nanofab_Yu-Kun_Feng_design.gds'.format(savepath))
     design_space_cell.show()
 
     return design_space_cell
@@ -0,0 +1,461 @@
+"""
+Compare two GDS files cell by cell and layer by layer.
+
+Cells are matched through content hashes first, so identical hierarchy is
+skipped without looking at a single polygon. Only where the hashes differ
+are the polygons flattened and XORed, one spatially indexed tile at a time.
+
+Usage: python gds_diff.py old.gds new.gds [--tile 100] [--min-area 1]
+"""
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+from collections import defaultdict
+from math import cos, sin, radians
+from struct import unpack
+
+import numpy as np
+from shapely.geometry import Polygon, LineString, box
+from shapely.ops import unary_union
+
+from polygon_store import save_gds
+
+# GDSII record types, see gdshelpers.export.gdsii_export
+UNITS = 0x03
+ENDLIB = 0x04
+BGNSTR = 0x05
+STRNAME = 0x06
+BOUNDARY = 0x08
+PATH = 0x09
+SREF = 0x0A
+AREF = 0x0B
+TEXT = 0x0C
+LAYER = 0x0D
+DATATYPE = 0x0E
+WIDTH = 0x0F
+XY = 0x10
+ENDEL = 0x11
+SNAME = 0x12
+COLROW = 0x13
+NODE = 0x15
+STRANS = 0x1A
+MAG = 0x1B
+ANGLE = 0x1C
+PATHTYPE = 0x21
+BOX = 0x2D
+BOXTYPE = 0x2E
+
+DEFAULT_TILE_SIZE = 100
+# In database units squared, differences below this are rounding, e.g. of the same geometry fractured differently
+DEFAULT_MIN_AREA = 1
+
+
+def _real_from_8byte(data):
+    """
+    Inverse of gdshelpers.export.gdsii_export._real_to_8byte.
+    """
+    exponent = (data[0] & 0x7f) - 64
+    mantissa = int.from_bytes(data[1:8], 'big')
+    value = mantissa * 16. ** (exponent - 14)
+    return -value if data[0] & 0x80 else value
+
+
+def _transform(origin, angle=0., magnification=1., x_reflection=False):
+    """
+    3x3 matrix of a GDS reference: reflection, magnification, rotation, then translation.
+    """
+    c, s = cos(radians(angle)) * magnification, sin(radians(angle)) * magnification
+    f = -1 if x_reflection else 1
+    return np.array([[c, -s * f, origin[0]],
+                     [s, c * f, origin[1]],
+                     [0, 0, 1]])
+
+
+def _finish_element(cell, element):
+    if element['kind'] in ('polygon', 'path'):
+        xy = np.concatenate(element['xy']).reshape(-1, 2).astype(np.int64)
+        layer = (element['layer'], element['datatype'])
+        if element['kind'] == 'polygon':
+            cell['polygons'][layer].append(xy)
+        else:
+            cell['paths'][layer].append((xy, element['width'], element['pathtype']))
+    elif element['kind'] == 'ref':
+        xy = np.concatenate(element['xy']).reshape(-1, 2).astype(float)
+        angle, magnification, x_reflection = element['angle'], element['magnification'], element['x_reflection']
+        if element['colrow'] is None:
+            transforms = [_transform(xy[0], angle, magnification, x_reflection)]
+        else:
+            # The lattice vectors of an AREF are given in the coordinates of the parent
+            columns, rows = element['colrow']
+            column_step, row_step = (xy[1] - xy[0]) / columns, (xy[2] - xy[0]) / rows
+            transforms = [_transform(xy[0] + i * column_step + j * row_step, angle, magnification, x_reflection)
+                          for i in range(columns) for j in range(rows)]
+        cell['refs'].append(dict(name=element['name'], transforms=transforms))
+
+
+def read_gds(filename):
+    """
+    Read the geometry of a GDS file. Text and node elements are ignored.
+
+    :param filename: Path of the GDS file
+    :return: dict of cell name to cell, size of a database unit in um
+    """
+    with open(filename, 'rb') as f:
+        data = memoryview(f.read())
+
+    cells = {}
+    cell = None
+    element = None
+    unit = 1e-3
+    position = 0
+    while position + 4 <= len(data):
+        size, record = unpack('>HB', data[position:position + 3])
+        payload = data[position + 4:position + size]
+        position += max(size, 4)
+
+        if record == UNITS:
+            # Size of the database unit in meters, converted to um
+            unit = _real_from_8byte(payload[8:16]) * 1e6
+        elif record == BGNSTR:
+            cell = dict(polygons=defaultdict(list), paths=defaultdict(list), refs=[])
+        elif record == STRNAME:
+            cells[bytes(payload).rstrip(b'\0').decode('ascii')] = cell
+        elif record in (BOUNDARY, BOX):
+            element = dict(kind='polygon', layer=0, datatype=0, xy=[])
+        elif record == PATH:
+            element = dict(kind='path', layer=0, datatype=0, width=0, pathtype=0, xy=[])
+        elif record in (SREF, AREF):
+            element = dict(kind='ref', name=None, angle=0., magnification=1., x_reflection=False, colrow=None, xy=[])
+        elif record in (TEXT, NODE):
+            element = dict(kind='ignored', xy=[])
+        elif record == LAYER:
+            element['layer'] = unpack('>h', payload[:2])[0]
+        elif record in (DATATYPE, BOXTYPE):
+            element['datatype'] = unpack('>h', payload[:2])[0]
+        elif record == WIDTH:
+            element['width'] = unpack('>i', payload[:4])[0]
+        elif record == PATHTYPE:
+            element['pathtype'] = unpack('>h', payload[:2])[0]
+        elif record == XY:
+            element['xy'].append(np.frombuffer(payload, dtype='>i4'))
+        elif record == SNAME:
+            element['name'] = bytes(payload).rstrip(b'\0').decode('ascii')
+        elif record == STRANS:
+            element['x_reflection'] = bool(unpack('>H', payload[:2])[0] & 0x8000)
+        elif record == MAG:
+            element['magnification'] = _real_from_8byte(payload)
+        elif record == ANGLE:
+            element['angle'] = _real_from_8byte(payload)
+        elif record == COLROW:
+            element['colrow'] = unpack('>2h', payload[:4])
+        elif record == ENDEL:
+            _finish_element(cell, element)
+            element = None
+        elif record == ENDLIB:
+            break
+
+    return cells, unit
+
+
+def _normalise(xy):
+    """
+    Polygon with the closing point removed, counter-clockwise and starting at its
+    lowest vertex, so that equal polygons give equal bytes.
+    """
+    while len(xy) > 1 and (xy[-1] == xy[0]).all():
+        xy = xy[:-1]
+    # Orientation from the shoelace sum in floating point, large masks overflow int64
+    x, y = xy[:, 0].astype(float), xy[:, 1].astype(float)
+    if np.dot(x, np.roll(y, -1)) - np.dot(np.roll(x, -1), y) < 0:
+        xy = xy[::-1]
+    return np.roll(xy, -np.lexsort((xy[:, 1], xy[:, 0]))[0], axis=0)
+
+
+def _transform_key(matrix):
+    return tuple(np.round(matrix[:2].ravel(), 6))
+
+
+def layer_hashes(cell):
+    """
+    Hash of the geometry drawn directly in a cell, per layer.
+    """
+    hashes = {}
+    for layer in set(cell['polygons']) | set(cell['paths']):
+        items = sorted(_normalise(xy).tobytes() for xy in cell['polygons'].get(layer, []))
+        items += sorted(xy.tobytes() + np.array([width, pathtype], dtype=np.int64).tobytes()
+                        for xy, width, pathtype in cell['paths'].get(layer, []))
+        hashes[layer] = hashlib.sha1(b''.join(len(item).to_bytes(8, 'big') + item for item in items)).hexdigest()
+    return hashes
+
+
+def cell_hashes(cells):
+    """
+    Hash of every cell including its whole hierarchy. Names of child cells do not
+    enter the hash, so cells with generated names (e.g. the grating couplers) still match.
+
+    :param cells: dict returned by read_gds
+    :return: dict of cell name to hash
+    """
+    hashes = {}
+
+    def deep_hash(name):
+        if name not in hashes:
+            cell = cells[name]
+            content = sorted('{}:{}'.format(layer, h) for layer, h in layer_hashes(cell).items())
+            content += sorted('{}@{}'.format(deep_hash(ref['name']), _transform_key(transform))
+                              for ref in cell['refs'] for transform in ref['transforms'])
+            hashes[name] = hashlib.sha1('\n'.join(content).encode('ascii')).hexdigest()
+        return hashes[name]
+
+    for name in cells:
+        deep_hash(name)
+    return hashes
+
+
+def top_cells(cells):
+    referenced = {ref['name'] for cell in cells.values() for ref in cell['refs']}
+    return [name for name in cells if name not in referenced]
+
+
+def _apply(matrix, xy):
+    return np.rint(xy @ matrix[:2, :2].T + matrix[:2, 2]).astype(np.int64)
+
+
+def _path_to_polygon(xy, width, pathtype):
+    # pathtype 0 is flush, 1 round and 2 square ended
+    cap_style = {0: 2, 1: 1, 2: 3}.get(pathtype, 2)
+    outline = LineString(xy).buffer(abs(width) / 2, cap_style=cap_style, join_style=2)
+    return np.array(outline.exterior.coords)
+
+
+def _flatten_layers(cells, cell, matrix, layers, out):
+    for layer in layers:
+        for xy in cell['polygons'].get(layer, []):
+            out[layer].append(_apply(matrix, xy))
+        for xy, width, pathtype in cell['paths'].get(layer, []):
+            if width:
+                out[layer].append(_apply(matrix, _path_to_polygon(xy, width, pathtype)))
+
+
+def _flatten(cells, name, matrix, out):
+    """
+    Collect all polygons below a cell in the coordinates given by `matrix`.
+    """
+    cell = cells[name]
+    _flatten_layers(cells, cell, matrix, set(cell['polygons']) | set(cell['paths']), out)
+    for ref in cell['refs']:
+        for transform in ref['transforms']:
+            _flatten(cells, ref['name'], matrix @ transform, out)
+
+
+def _shapely_union(polygons):
+    shapes = []
+    for xy in polygons:
+        polygon = Polygon(xy)
+        shapes.append(polygon if polygon.is_valid else polygon.buffer(0))
+    return unary_union(shapes)
+
+
+def _tile_index(polygons, tile):
+    """
+    Spatial index of polygons: dict of (column, row) tile to polygon indices.
+    """
+    index = defaultdict(list)
+    for i, xy in enumerate(polygons):
+        (x0, y0), (x1, y1) = xy.min(axis=0) // tile, xy.max(axis=0) // tile
+        for column in range(int(x0), int(x1) + 1):
+            for row in range(int(y0), int(y1) + 1):
+                index[(column, row)].append(i)
+    return index
+
+
+def tiled_xor(polygons_a, polygons_b, tile, min_area=DEFAULT_MIN_AREA):
+    """
+    XOR of two sets of polygons, evaluated tile by tile. Tiles holding the same
+    polygons on both sides are skipped without any boolean operation.
+
+    :param polygons_a: list of (N, 2) coordinate arrays in database units
+    :param polygons_b: list of (N, 2) coordinate arrays in database units
+    :param tile: Tile edge length in database units
+    :param min_area: Tiles with an XOR area up to this count as unchanged, in database units squared
+    :return: dict of (column, row) tile to (bounds, area) of the difference
+    """
+    index_a, index_b = _tile_index(polygons_a, tile), _tile_index(polygons_b, tile)
+    changed = {}
+    for key in set(index_a) | set(index_b):
+        in_a = [polygons_a[i] for i in index_a.get(key, [])]
+        in_b = [polygons_b[i] for i in index_b.get(key, [])]
+        if sorted(_normalise(xy).tobytes() for xy in in_a) == sorted(_normalise(xy).tobytes() for xy in in_b):
+            continue
+        tile_box = box(key[0] * tile, key[1] * tile, (key[0] + 1) * tile, (key[1] + 1) * tile)
+        difference = _shapely_union(in_a).intersection(tile_box).symmetric_difference(
+            _shapely_union(in_b).intersection(tile_box))
+        if difference.area > min_area:
+            changed[key] = (difference.bounds, difference.area)
+    return changed
+
+
+def _merge_tiles(changed):
+    """
+    Join neighbouring changed tiles into regions.
+    :return: list of (bounds, area)
+    """
+    regions = []
+    remaining = set(changed)
+    while remaining:
+        stack = [remaining.pop()]
+        bounds, area = [], 0
+        while stack:
+            column, row = stack.pop()
+            bounds.append(changed[(column, row)][0])
+            area += changed[(column, row)][1]
+            for neighbour in ((column + i, row + j) for i in (-1, 0, 1) for j in (-1, 0, 1)):
+                if neighbour in remaining:
+                    remaining.remove(neighbour)
+                    stack.append(neighbour)
+        bounds = np.array(bounds)
+        regions.append(((*bounds[:, :2].min(axis=0), *bounds[:, 2:].max(axis=0)), area))
+    return regions
+
+
+def diff_gds(filename_a, filename_b, tile_size=DEFAULT_TILE_SIZE, min_area=DEFAULT_MIN_AREA):
+    """
+    Compare the geometry of two GDS files.
+
+    Hierarchy with equal hashes is skipped. Where a cell differs, references with
+    the same cell name and placement are compared recursively, so changes are
+    reported by the deepest device cell they belong to. Everything else in the
+    differing cell is flattened and XORed per layer on tiles of `tile_size`.
+
+    :param filename_a: Path of the first GDS file
+    :param filename_b: Path of the second GDS file
+    :param tile_size: Tile edge length in um
+    :param min_area: Tiles with an XOR area up to this count as unchanged, in database units squared
+    :return: list of dicts with device, layer, bounds (um) and area (um^2) of each changed region
+    """
+    cells_a, unit = read_gds(filename_a)
+    cells_b, unit_b = read_gds(filename_b)
+    if not np.isclose(unit, unit_b):
+        raise ValueError('Database units differ: {} um and {} um'.format(unit, unit_b))
+    hashes_a, hashes_b = cell_hashes(cells_a), cell_hashes(cells_b)
+    tile = max(int(round(tile_size / unit)), 1)
+    report = []
+
+    def compare(name_a, name_b, matrix, device):
+        if hashes_a[name_a] == hashes_b[name_b]:
+            return
+        cell_a, cell_b = cells_a[name_a], cells_b[name_b]
+        polygons_a, polygons_b = defaultdict(list), defaultdict(list)
+
+        # Geometry drawn in the cell itself, only on the layers which changed
+        own_a, own_b = layer_hashes(cell_a), layer_hashes(cell_b)
+        layers = {layer for layer in set(own_a) | set(own_b) if own_a.get(layer) != own_b.get(layer)}
+        _flatten_layers(cells_a, cell_a, matrix, layers, polygons_a)
+        _flatten_layers(cells_b, cell_b, matrix, layers, polygons_b)
+
+        # Drop references present on both sides, whatever the cell is called
+        refs_a = defaultdict(list)
+        for ref in cell_a['refs']:
+            for transform in ref['transforms']:
+                refs_a[(hashes_a[ref['name']], _transform_key(transform))].append((ref['name'], transform))
+        unmatched_b = []
+        for ref in cell_b['refs']:
+            for transform in ref['transforms']:
+                same = refs_a.get((hashes_b[ref['name']], _transform_key(transform)))
+                if same:
+                    same.pop()
+                else:
+                    unmatched_b.append((ref['name'], transform))
+
+        # Changed references to a cell of the same name at the same place are compared as a device
+        by_placement = defaultdict(list)
+        for refs in refs_a.values():
+            for ref_name, transform in refs:
+                by_placement[(ref_name, _transform_key(transform))].append(transform)
+        for ref_name, transform in unmatched_b:
+            same = by_placement.get((ref_name, _transform_key(transform)))
+            if same:
+                same.pop()
+                compare(ref_name, ref_name, matrix @ transform, device + '/' + ref_name)
+            else:
+                _flatten(cells_b, ref_name, matrix @ transform, polygons_b)
+        for (ref_name, _), transforms in by_placement.items():
+            for transform in transforms:
+                _flatten(cells_a, ref_name, matrix @ transform, polygons_a)
+
+        for layer in set(polygons_a) | set(polygons_b):
+            changed = tiled_xor(polygons_a.get(layer, []), polygons_b.get(layer, []), tile, min_area)
+            for bounds, area in _merge_tiles(changed):
+                report.append(dict(device=device, layer=layer,
+                                   bounds=tuple(float(value) * unit for value in bounds),
+                                   area=area * unit ** 2))
+
+    tops_a, tops_b = top_cells(cells_a), top_cells(cells_b)
+    if len(tops_a) == 1 and len(tops_b) == 1:
+        pairs = [(tops_a[0], tops_b[0])]
+    else:
+        pairs = [(name, name) for name in tops_a if name in tops_b]
+    for name_a, name_b in pairs:
+        compare(name_a, name_b, np.identity(3), name_b)
+
+    # Top cells which only exist on one side are reported as a whole
+    paired_a, paired_b = {a for a, _ in pairs}, {b for _, b in pairs}
+    for cells, tops, paired in ((cells_a, tops_a, paired_a), (cells_b, tops_b, paired_b)):
+        for name in tops:
+            if name not in paired:
+                polygons = defaultdict(list)
+                _flatten(cells, name, np.identity(3), polygons)
+                for layer, layer_polygons in polygons.items():
+                    for bounds, area in _merge_tiles(tiled_xor(layer_polygons, [], tile, min_area)):
+                        report.append(dict(device=name, layer=layer,
+                                           bounds=tuple(float(value) * unit for value in bounds),
+                                           area=area * unit ** 2))
+
+    return report
+
+
+def compare_build_modes(cell, savepath=None):
+    """
+    Check that the ways of writing a mask give the same geometry as a serial
+    Cell.save: Cell.save in parallel and polygon_store.save_gds.
+
+    :param cell: gdshelpers Cell to save
+    :param savepath: Directory the GDS files are written to, defaults to a new temporary directory
+    :return: dict of build mode to report of diff_gds, all empty if the modes match
+    """
+    savepath = savepath or tempfile.mkdtemp()
+    serial = os.path.join(savepath, '{}_serial.gds'.format(cell.name))
+    parallel = os.path.join(savepath, '{}_parallel.gds'.format(cell.name))
+    compact = os.path.join(savepath, '{}_save_gds.gds'.format(cell.name))
+    cell.save(serial)
+    cell.save(parallel, parallel=True)
+    save_gds(cell, compact)
+
+    return {'parallel': diff_gds(serial, parallel),
+            'save_gds': diff_gds(serial, compact)}
+
+
+def print_report(report):
+    if not report:
+        print('No geometry changes')
+        return
+    for region in report:
+        print('{device}  layer {layer[0]}/{layer[1]}  bounds ({b[0]:.3f}, {b[1]:.3f}, {b[2]:.3f}, {b[3]:.3f})'
+              '  XOR area {area:.6f} um^2'.format(b=region['bounds'], **region))
+    print('{} changed region(s)'.format(len(report)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the geometry of two GDS files.')
+    parser.add_argument('old', help='Reference GDS file')
+    parser.add_argument('new', help='GDS file to check')
+    parser.add_argument('--tile', type=float, default=DEFAULT_TILE_SIZE, help='Tile edge length in um')
+    parser.add_argument('--min-area', type=float, default=DEFAULT_MIN_AREA,
+                        help='Tiles with an XOR area up to this count as unchanged, in database units squared')
+    args = parser.parse_args()
+
+    changes = diff_gds(args.old, args.new, tile_size=args.tile, min_area=args.min_area)
+    print_report(changes)
+    sys.exit(1 if changes else 0)
@@ -7,6 +7,7 @@ from math import pi
 WAVEGUIDE_LAYER = 3
 GRATING_LAYER = 4
 BEND_RADIUS = 10
+GRID_STEPS_PER_MICRON = 1000
 
 ###########################
 # GRATING COUPLER PARAMETERS
@@ -29,3 +30,18 @@ coupler_parameters = {
 }
 
 
+###########################
+# FABRICATION VARIATION PARAMETERS
+###########################
+VARIANT_SEED = 2022
+CORNER_SIGMAS = 3
+GAP_SIGMA = 0.02
+RADIUS_SIGMA = 0.05
+UPPER_VERTICAL_LENGTH_SIGMA = 0.1
+GRATING_FF_SIGMA = 0.02
+
+###########################
+# GEOMETRY STORAGE PARAMETERS
+###########################
+# Directory for memory-mapped polygon stores, None keeps them in RAM
+POLYGON_STORE_PATH = None
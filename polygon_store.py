@@ -0,0 +1,420 @@
+"""
+Memory-compact storage of layer geometry.
+
+A PolygonStore keeps the polygons of one layer as a single int32 coordinate
+array on the database-unit grid, plus an index of where each polygon starts.
+Shapely objects are only created when asked for, and save_gds writes the
+boundaries of a CompactCell straight from the arrays.
+
+With a backing directory the coordinates live in files in that directory
+and are memory-mapped when read. The directory belongs to the caller: each
+store creates its own uniquely named file, close() deletes it again, and
+files left behind by an interrupted run can simply be removed.
+"""
+import datetime
+import math
+import os
+import tempfile
+import warnings
+from array import array
+from io import BytesIO
+from struct import pack
+
+import numpy as np
+from shapely.geometry import Polygon, LineString
+from gdshelpers.geometry.chip import Cell
+from gdshelpers.geometry import geometric_union
+from gdshelpers.geometry.shapely_adapter import shapely_collection_to_basic_objs, fracture_intelligently, \
+    bounds_union
+
+from parameters import *
+
+# Default of gdshelpers, polygons are fractured to this when they are added
+MAX_POINTS = 4000
+
+
+class PolygonStore:
+    """Polygons of one layer as flat int32 coordinates on the database-unit grid.
+    Polygon i holds the vertices offsets[i] to offsets[i + 1] of the coordinate array."""
+
+    def __init__(self, grid_steps_per_micron=GRID_STEPS_PER_MICRON, store_path=None, prefix='', max_points=MAX_POINTS):
+        """
+        :param grid_steps_per_micron: Database units per um, the same as used when saving
+        :param store_path: Optional directory for a backing file, the coordinates are then
+            memory-mapped instead of kept in RAM
+        :param prefix: Start of the name of the backing file
+        :param max_points: Maximum number of points of a polygon
+        """
+        self.grid_steps_per_micron = grid_steps_per_micron
+        self.max_points = max_points
+        self.offsets = array('q', [0])
+        self.others = []
+        self._bounds = None
+        self._buffer = np.empty((0, 2), dtype=np.int32)
+        self.filename = None
+
+        if store_path is not None:
+            # A new file for every store, existing files are never overwritten
+            handle, self.filename = tempfile.mkstemp(suffix='.bin', prefix=prefix, dir=store_path)
+            os.close(handle)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        coordinates = self.coordinates
+        for i in range(len(self)):
+            yield coordinates[self.offsets[i]:self.offsets[i + 1]]
+
+    def __getstate__(self):
+        # Only pickle the used part of the buffer, e.g. for the processes of a parallel save
+        state = self.__dict__.copy()
+        state['_buffer'] = self._buffer[:self.offsets[-1]]
+        return state
+
+    def polygon(self, i):
+        """
+        Coordinates of polygon `i` in database units.
+        """
+        return self.coordinates[self.offsets[i]:self.offsets[i + 1]]
+
+    @property
+    def coordinates(self):
+        """
+        All vertices as a (N, 2) int32 array in database units. With a backing file this is a
+        fresh read-only memory map, which releases the file when it is no longer referenced.
+        """
+        if self.filename is None:
+            return self._buffer[:self.offsets[-1]]
+        if self.offsets[-1] == 0:
+            return np.empty((0, 2), dtype=np.int32)
+        return np.memmap(self.filename, dtype=np.int32, mode='r', shape=(self.offsets[-1], 2))
+
+    @property
+    def nbytes(self):
+        """
+        Memory taken by the coordinates and offsets, without the memory-mapped file.
+        """
+        return self._buffer.nbytes + self.offsets.itemsize * len(self.offsets)
+
+    @property
+    def bounds(self):
+        return self._bounds if self._bounds is not None else ()
+
+    def add(self, *geometry):
+        """
+        Adds geometry the same way Cell.get_fractured_layer_dict would handle it at save,
+        only the resulting coordinates are kept.
+
+        :param geometry: gdshelpers parts and/or shapely geometry
+        """
+        polygons = []
+        for geo in geometry:
+            geo = geo.get_shapely_object() if hasattr(geo, 'get_shapely_object') else geo
+            if type(geo) in [list, tuple]:
+                geo = geometric_union(geo)
+            for basic in shapely_collection_to_basic_objs(geo):
+                if basic.is_empty:
+                    continue
+                for piece in fracture_intelligently(basic, self.max_points, self.max_points):
+                    self._bounds = bounds_union([self._bounds, piece.bounds]) if self._bounds is not None \
+                        else piece.bounds
+                    if not isinstance(piece, Polygon):
+                        # Lines are rare and kept as they are
+                        self.others.append(piece)
+                        continue
+                    if piece.interiors:
+                        raise AssertionError('GDSII only supports polygons without holes')
+                    polygons.append(np.round(np.array(piece.exterior.coords) * self.grid_steps_per_micron)
+                                    .astype(np.int32))
+        if polygons:
+            self._append(polygons)
+
+    def _append(self, polygons):
+        xy = np.concatenate(polygons)
+        start = self.offsets[-1]
+        if self.filename is None:
+            if start + len(xy) > len(self._buffer):
+                grown = np.empty((max(2 * len(self._buffer), start + len(xy), 1024), 2), dtype=np.int32)
+                grown[:start] = self._buffer[:start]
+                self._buffer = grown
+            self._buffer[start:start + len(xy)] = xy
+        else:
+            # Opened per call, so any number of stores can share a process
+            with open(self.filename, 'ab') as f:
+                f.write(xy.tobytes())
+        for polygon in polygons:
+            start += len(polygon)
+            self.offsets.append(start)
+
+    def fits(self, max_points, max_line_points):
+        """
+        Whether the stored polygons and lines are fractured to at most these numbers of points.
+        """
+        return self.max_points <= max_points and self.max_points <= max_line_points
+
+    def close(self):
+        """
+        Delete the geometry, including the backing file.
+        """
+        if self.filename is not None and os.path.exists(self.filename):
+            os.remove(self.filename)
+        self.offsets = array('q', [0])
+        self.others = []
+        self._bounds = None
+        self._buffer = np.empty((0, 2), dtype=np.int32)
+
+    def get_shapely_polygons(self):
+        """
+        Shapely polygons in um, one per stored polygon, followed by the other geometry.
+        """
+        scale = 1. / self.grid_steps_per_micron
+        return [Polygon(xy * scale) for xy in self] + self.others
+
+    def get_shapely_object(self):
+        """
+        The whole layer merged into one shapely geometry in um.
+        """
+        return geometric_union(self.get_shapely_polygons())
+
+
+class CompactCell(Cell):
+    """gdshelpers Cell keeping its layers in PolygonStores.
+    Drop-in for Cell, geometry is converted when it is added."""
+
+    def __init__(self, name, store_path=POLYGON_STORE_PATH):
+        """
+        :param name: Name of the cell, needs to be unique
+        :param store_path: Directory for memory-mapped backing files, None keeps the coordinates in RAM
+        """
+        super().__init__(name)
+        self.store_path = store_path
+
+    def add_to_layer(self, layer, *geometry):
+        """
+        Adds geometry to the PolygonStore of the layer
+
+        :param layer: id of the layer, a tuple (layer, datatype) can also be passed to define the datatype as well
+        :param geometry: shapely geometry or gdshelpers parts
+        """
+        if layer not in self.layer_dict:
+            layer_name = layer if isinstance(layer, int) else '{}_{}'.format(*layer)
+            self.layer_dict[layer] = [PolygonStore(store_path=self.store_path,
+                                                   prefix='{}_{}_'.format(self.name, layer_name))]
+        store = self.layer_dict[layer][0]
+        store.add(*geometry)
+
+        # Keep the bounds up to date, so placing the cell never converts the stores
+        if store.bounds:
+            self._bounds = bounds_union([self._bounds, store.bounds]) if self._bounds is not None else store.bounds
+
+    def get_fractured_layer_dict(self, max_points=MAX_POINTS, max_line_points=MAX_POINTS):
+        # Stores are fractured to their own max_points when geometry is added, lower limits fracture again
+        fractured_layer_dict = {}
+        for layer, stores in self.layer_dict.items():
+            geometry = stores[0].get_shapely_polygons()
+            if not stores[0].fits(max_points, max_line_points):
+                geometry = [piece for geo in geometry for piece in fracture_intelligently(geo, max_points,
+                                                                                          max_line_points)]
+            fractured_layer_dict[layer] = iter(geometry)
+        return fractured_layer_dict
+
+    def close(self):
+        """
+        Delete the geometry of all layers, including their backing files.
+        """
+        for stores in self.layer_dict.values():
+            stores[0].close()
+        self.layer_dict = {}
+        self._bounds = None
+
+
+def _real_to_8byte(value):
+    """
+    GDSII 8-byte real: sign bit, 7-bit exponent of 16 with an offset of 64 and a 56-bit mantissa.
+    """
+    if value == 0:
+        return b'\x00' * 8
+    exponent = int((math.log(abs(value), 16) + 1) // 1)
+    mantissa = int(abs(value) * 16. ** (14 - exponent))
+    return ((((0b1 if value < 0 else 0b0) + exponent + 64) << 56) + mantissa).to_bytes(8, 'big')
+
+
+def _layer_header(record, layer):
+    layer, datatype = (layer, layer) if isinstance(layer, int) else layer
+    return pack('>8H', 4, record, 6, 0x0D02, layer, 6, 0x0E02, datatype)  # BOUNDARY/PATH LAYER DATATYPE
+
+
+def _xy_to_gdsii_binary(xy):
+    """
+    XY records of int32 coordinates, split in blocks of 8191 points.
+    """
+    xy = xy.astype('>i4', copy=False)
+    binary = b''
+    for start in range(0, len(xy), 8191):
+        stop = min(start + 8191, len(xy))
+        binary += pack('>2H', 4 + 8 * (stop - start), 0x1003) + xy[start:stop].tobytes()  # XY INTEGER_4
+    return binary
+
+
+def _store_to_gdsii_binary(store, layer, grid_steps_per_unit):
+    """
+    BOUNDARY records of all polygons in a store, assembled in one pass over the coordinate array.
+    Like gdshelpers, the first point is repeated after the closed ring, so both writers give the same bytes.
+    """
+    coordinates = store.coordinates
+    if grid_steps_per_unit != store.grid_steps_per_micron:
+        coordinates = np.round(coordinates * (grid_steps_per_unit / store.grid_steps_per_micron))
+    offsets = np.frombuffer(store.offsets, dtype=np.int64)
+    points = np.diff(offsets) + 1
+    if not len(points):
+        return b''
+    if points.max() > 8191:
+        # Longer boundaries need more than one XY record
+        header, endel = _layer_header(0x0800, layer), pack('>2H', 4, 0x1100)  # ENDEL
+        return b''.join(header + _xy_to_gdsii_binary(np.concatenate((xy, xy[:1]))) + endel
+                        for xy in (coordinates[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])))
+
+    # Each record is 4-byte words: BOUNDARY, LAYER and DATATYPE header, XY header, the points, ENDEL
+    words = 6 + 2 * points
+    starts = np.cumsum(words) - words
+    records = np.empty(words.sum(), dtype='>u4')
+    records[starts[:, None] + np.arange(4)] = np.frombuffer(_layer_header(0x0800, layer), dtype='>u4')
+    records[starts + 4] = ((4 + 8 * points) << 16) | 0x1003  # XY INTEGER_4
+    records[starts + words - 1] = (4 << 16) | 0x1100  # ENDEL
+
+    is_point = np.ones(len(records), dtype=bool)
+    is_point[starts[:, None] + np.arange(5)] = False
+    is_point[starts + words - 1] = False
+    closed = np.insert(np.arange(offsets[-1]), offsets[1:], offsets[:-1])
+    records.view('>i4')[is_point] = coordinates[closed].astype(np.int32).ravel()
+    return records.tobytes()
+
+
+def _geometry_to_gdsii_binary(geometry, layer, grid_steps_per_unit):
+    """
+    BOUNDARY and PATH records of fractured shapely polygons and lines.
+    """
+    with BytesIO() as b:
+        for shapely_object in geometry:
+            if isinstance(shapely_object, Polygon):
+                if shapely_object.interiors:
+                    raise AssertionError('GDSII only supports polygons without holes')
+                coords = list(shapely_object.exterior.coords) + [shapely_object.exterior.coords[0]]
+                b.write(_layer_header(0x0800, layer))
+            elif isinstance(shapely_object, LineString):
+                coords = shapely_object.coords
+                b.write(_layer_header(0x0900, layer))
+                if hasattr(shapely_object, 'width'):
+                    b.write(pack('>2Hi', 8, 0x0F03, round(shapely_object.width * grid_steps_per_unit)))  # WIDTH
+            else:
+                warnings.warn('Shapely object of type ' + str(type(shapely_object)) +
+                              ' not convertible to GDSII, skipping...')
+                continue
+            b.write(_xy_to_gdsii_binary(np.round(np.array(coords) * grid_steps_per_unit)))
+            b.write(pack('>2H', 4, 0x1100))  # ENDEL
+        return b.getvalue()
+
+
+def _refs_to_gdsii_binary(refs, grid_steps_per_unit):
+    """
+    SREF and AREF records of the cells added with Cell.add_cell.
+    """
+    with BytesIO() as b:
+        for ref in refs:
+            aref = not (ref['columns'] == 1 and ref['rows'] == 1 and not ref['spacing'])
+            name = ref['cell'].name + '\0' * (len(ref['cell'].name) % 2)
+            b.write(pack('>2H', 4, 0x0B00 if aref else 0x0A00))  # AREF/SREF
+            b.write(pack('>2H', 4 + len(name), 0x1206) + name.encode('ascii'))  # SNAME
+            if (ref['angle'] is not None) or (ref['magnification'] is not None) or ref['x_reflection']:
+                b.write(pack('>3H', 6, 0x1A01, 1 << 15 if ref['x_reflection'] else 0))  # STRANS
+                if ref['magnification'] is not None:
+                    b.write(pack('>2H', 12, 0x1B05) + _real_to_8byte(ref['magnification']))  # MAG
+                if ref['angle'] is not None:
+                    b.write(pack('>2H', 12, 0x1C05) + _real_to_8byte(np.rad2deg(ref['angle']) % 360.))  # ANGLE
+            origin = np.array(ref['origin'])
+            points = [origin]
+            if aref:
+                b.write(pack('>2H2h', 8, 0x1302, ref['columns'], ref['rows']))  # COLROW
+                points += [np.array((ref['spacing'][0] * ref['columns'], 0)) + origin,
+                           np.array((0, ref['spacing'][1] * ref['rows'])) + origin]
+            b.write(pack('>2H', 4 + 8 * len(points), 0x1003) +
+                    np.round(np.array(points) * grid_steps_per_unit).astype('>i4').tobytes())  # XY
+            b.write(pack('>2H', 4, 0x1100))  # ENDEL
+        return b.getvalue()
+
+
+def _cell_to_gdsii_binary(cell, grid_steps_per_unit, max_points, timestamp):
+    """
+    One GDSII structure. CompactCells are written from their coordinate arrays,
+    unless they hold polygons of more than max_points, other cells from
+    Cell.get_fractured_layer_dict.
+    """
+    name = cell.name + '\0' * (len(cell.name) % 2)
+    with BytesIO() as b:
+        b.write(pack('>14H', 28, 0x0502, *timestamp.timetuple()[:6] * 2))  # BGNSTR
+        b.write(pack('>2H', 4 + len(name), 0x0606) + name.encode('ascii'))  # STRNAME
+        if isinstance(cell, CompactCell) and all(stores[0].fits(max_points, max_points)
+                                                 for stores in cell.layer_dict.values()):
+            for layer, stores in cell.layer_dict.items():
+                b.write(_store_to_gdsii_binary(stores[0], layer, grid_steps_per_unit))
+                b.write(_geometry_to_gdsii_binary(stores[0].others, layer, grid_steps_per_unit))
+        else:
+            for layer, geometry in cell.get_fractured_layer_dict(max_points, max_points).items():
+                b.write(_geometry_to_gdsii_binary(geometry, layer, grid_steps_per_unit))
+        b.write(_refs_to_gdsii_binary(cell.cells, grid_steps_per_unit))
+        b.write(pack('>2H', 4, 0x0700))  # ENDSTR
+        return b.getvalue()
+
+
+def save_gds(cell, filename, unit=1e-6, grid_steps_per_micron=GRID_STEPS_PER_MICRON, max_points=MAX_POINTS,
+             timestamp=None, parallel=False, max_workers=None):
+    """
+    Save a cell and its hierarchy as GDS, giving the same file as Cell.save,
+    but writing CompactCells directly from their coordinate arrays.
+
+    :param cell: Top cell, a Cell or CompactCell
+    :param filename: Name of the GDS file
+    :param unit: User unit in meters
+    :param grid_steps_per_micron: Defines the resolution
+    :param max_points: Maximum number of points of polygons
+    :param timestamp: Modification time written to the file, defaults to now
+    :param parallel: Write the cells in parallel processes
+    :param max_workers: If parallel is True, this can be used to limit the number of parallel processes.
+    """
+    timestamp = datetime.datetime.now() if timestamp is None else timestamp
+    grid_step_unit = unit / grid_steps_per_micron
+
+    # Every cell of the hierarchy once, cell names have to be unique
+    cells = []
+    cell_names = set()
+    pending = [cell]
+    while pending:
+        current = pending.pop()
+        if any(current is c for c in cells):
+            continue
+        if current.name in cell_names:
+            raise AssertionError('Each cell name must be unique, "{}" is used more than once'.format(current.name))
+        cells.append(current)
+        cell_names.add(current.name)
+        pending += [ref['cell'] for ref in reversed(current.cells)]
+
+    name = 'gdshelpers_exported_library'
+    name = name + '\0' * (len(name) % 2)
+    with open(filename, 'wb') as outfile:
+        outfile.write(pack('>3H', 6, 0x0002, 0x258))  # HEADER
+        outfile.write(pack('>14H', 28, 0x0102, *timestamp.timetuple()[:6] * 2))  # BGNLIB
+        outfile.write(pack('>2H', 4 + len(name), 0x0206) + name.encode('ascii'))  # LIBNAME
+        outfile.write(pack('>2H', 20, 0x0305) + _real_to_8byte(grid_step_unit / unit)
+                      + _real_to_8byte(grid_step_unit))  # UNITS
+        num = len(cells)
+        if parallel:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                for binary in pool.map(_cell_to_gdsii_binary, cells, (grid_steps_per_micron,) * num,
+                                       (max_points,) * num, (timestamp,) * num):
+                    outfile.write(binary)
+        else:
+            for c in cells:
+                outfile.write(_cell_to_gdsii_binary(c, grid_steps_per_micron, max_points, timestamp))
+        outfile.write(pack('>2H', 4, 0x0400))  # ENDLIB
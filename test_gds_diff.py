@@ -0,0 +1,103 @@
+from collections import defaultdict
+
+import numpy as np
+from gdshelpers.geometry.chip import Cell
+from gdshelpers.layout import GridLayout
+from shapely.geometry import Polygon
+
+from components import grating_loopback
+from gds_diff import diff_gds, compare_build_modes, read_gds, top_cells, tiled_xor, _flatten
+from parameters import coupler_parameters, GRID_STEPS_PER_MICRON
+from variants import ring_variant, mzi_variant, grating_variant
+
+# Left grating of the ring (d4), MZI (d7) and plain loopback (d10) devices in grating_loopback
+LOOPBACK_POSITIONS = {'ring': (640, 0), 'mzi': (1120, 0), 'grating': (1990, 0)}
+
+
+def build_layout(gap=1):
+    """
+    Small mask with two loopbacks, laid out like generate_blank_gds does.
+    """
+    layout = GridLayout(title='GDS_DIFF_TEST',
+                        frame_layer=99,
+                        text_layer=4,
+                        region_layer_type=None,
+                        tight=True,
+                        vertical_spacing=100,
+                        vertical_alignment=1,
+                        horizontal_spacing=10,
+                        horizontal_alignment=10,
+                        text_size=20,
+                        row_text_size=15
+                        )
+    layout.begin_new_row()
+    layout.add_to_row(ring_variant('RING_LOOPBACK', gap=gap, radius=20))
+    layout.add_to_row(mzi_variant('MZI_LOOPBACK', upper_vertical_length=50))
+    cell, mapping = layout.generate_layout()
+    return cell
+
+
+def flat_polygons(cell, filename):
+    """
+    Save a cell and return its polygons per layer, flattened into database units.
+    """
+    cell.save(filename)
+    cells, unit = read_gds(filename)
+    polygons = defaultdict(list)
+    _flatten(cells, top_cells(cells)[0], np.identity(3), polygons)
+    return polygons
+
+
+def test_identical_builds(tmp_path):
+    build_layout().save(str(tmp_path / 'a.gds'))
+    build_layout().save(str(tmp_path / 'b.gds'))
+
+    assert diff_gds(str(tmp_path / 'a.gds'), str(tmp_path / 'b.gds')) == []
+
+
+def test_perturbed_ring_gap(tmp_path):
+    build_layout().save(str(tmp_path / 'a.gds'))
+    build_layout(gap=1.1).save(str(tmp_path / 'b.gds'))
+
+    report = diff_gds(str(tmp_path / 'a.gds'), str(tmp_path / 'b.gds'))
+    assert len(report) == 1
+    assert report[0]['device'] == 'GRID_LAYOUT/RING_LOOPBACK'
+    assert report[0]['layer'] == (3, 3)
+    assert report[0]['area'] > 0
+
+
+def test_split_polygon_is_unchanged(tmp_path):
+    # The same triangle, once whole and once split through a point on its edge
+    whole, split = Cell('TRIANGLE'), Cell('TRIANGLE')
+    whole.add_to_layer(1, Polygon([(0, 0), (300, 0), (0, 250)]))
+    split.add_to_layer(1, Polygon([(0, 0), (300, 0), (150, 125)]), Polygon([(0, 0), (150, 125), (0, 250)]))
+    whole.save(str(tmp_path / 'a.gds'))
+    split.save(str(tmp_path / 'b.gds'))
+
+    assert diff_gds(str(tmp_path / 'a.gds'), str(tmp_path / 'b.gds')) == []
+    assert diff_gds(str(tmp_path / 'a.gds'), str(tmp_path / 'b.gds'), min_area=0) != []
+
+
+def test_build_modes_match(tmp_path):
+    reports = compare_build_modes(build_layout(), str(tmp_path))
+
+    assert reports == {mode: [] for mode in reports}
+
+
+def test_cached_variants_match_grating_loopback(tmp_path):
+    loopback = flat_polygons(grating_loopback(coupler_parameters, name='LOOPBACK'), str(tmp_path / 'loopback.gds'))
+    cached = {'ring': ring_variant('RING_CACHED', gap=1, radius=20),
+              'mzi': mzi_variant('MZI_CACHED', upper_vertical_length=50),
+              'grating': grating_variant('GRATING_CACHED')}
+
+    for device, cell in cached.items():
+        offset = np.array(LOOPBACK_POSITIONS[device]) * GRID_STEPS_PER_MICRON
+        variant = {layer: [xy + offset for xy in polygons]
+                   for layer, polygons in flat_polygons(cell, str(tmp_path / (cell.name + '.gds'))).items()}
+        corners = np.vstack([xy for polygons in variant.values() for xy in polygons])
+        low, high = corners.min(axis=0), corners.max(axis=0)
+        for layer in set(loopback) | set(variant):
+            # The polygons of grating_loopback within the footprint of the device
+            direct = [xy for xy in loopback.get(layer, []) if (xy.min(axis=0) >= low).all() and
+                      (xy.max(axis=0) <= high).all()]
+            assert tiled_xor(direct, variant.get(layer, []), 100 * GRID_STEPS_PER_MICRON) == {}, (device, layer)
@@ -0,0 +1,109 @@
+import os
+import pickle
+
+import numpy as np
+from gdshelpers.geometry.chip import Cell
+from shapely.geometry import Point, Polygon
+
+from gds_diff import diff_gds, read_gds, _normalise
+from polygon_store import PolygonStore, CompactCell, save_gds
+
+SQUARE = Polygon([(0, 0), (1.5, 0), (1.5, 1.5), (0, 1.5)])
+CIRCLE = Point(10, 10).buffer(5)
+
+
+def normalised(polygons):
+    return sorted(_normalise(np.asarray(xy, dtype=np.int64)).tobytes() for xy in polygons)
+
+
+def test_backing_file(tmp_path):
+    in_ram = PolygonStore()
+    on_disk = PolygonStore(store_path=str(tmp_path), prefix='LAYER_1_')
+    for store in (in_ram, on_disk):
+        store.add(SQUARE, CIRCLE)
+
+    assert os.path.dirname(on_disk.filename) == str(tmp_path)
+    assert os.path.basename(on_disk.filename).startswith('LAYER_1_')
+    assert os.path.getsize(on_disk.filename) == on_disk.coordinates.nbytes
+    assert isinstance(on_disk.coordinates, np.memmap)
+    assert np.array_equal(on_disk.coordinates, in_ram.coordinates)
+    assert list(on_disk.offsets) == list(in_ram.offsets)
+    assert normalised([on_disk.polygon(0)]) == normalised([[(0, 0), (1500, 0), (1500, 1500), (0, 1500)]])
+
+    # Stores of the same name never share a file
+    other = PolygonStore(store_path=str(tmp_path), prefix='LAYER_1_')
+    assert other.filename != on_disk.filename
+
+
+def test_close_deletes_backing_files(tmp_path):
+    cell = CompactCell('CLOSED', store_path=str(tmp_path))
+    cell.add_to_layer(1, SQUARE)
+    cell.add_to_layer((2, 1), CIRCLE)
+    assert len(os.listdir(str(tmp_path))) == 2
+
+    cell.close()
+
+    assert os.listdir(str(tmp_path)) == []
+    assert cell.layer_dict == {}
+
+
+def test_shapely_round_trip():
+    store = PolygonStore()
+    store.add(SQUARE, CIRCLE)
+
+    polygons = store.get_shapely_polygons()
+    assert len(polygons) == len(store) == 2
+    assert polygons[0].symmetric_difference(SQUARE).area < 1e-9
+    assert abs(store.get_shapely_object().area - SQUARE.union(CIRCLE).area) < 1e-3
+    assert store.bounds == SQUARE.union(CIRCLE).bounds
+
+
+def test_pickle_trims_buffer(tmp_path):
+    for store in (PolygonStore(), PolygonStore(store_path=str(tmp_path))):
+        store.add(SQUARE, CIRCLE)
+        copy = pickle.loads(pickle.dumps(store))
+
+        assert len(copy._buffer) <= store.offsets[-1]
+        assert list(copy.offsets) == list(store.offsets)
+        assert np.array_equal(copy.coordinates, store.coordinates)
+
+
+def test_parallel_save_with_backing_files(tmp_path):
+    store_path = tmp_path / 'stores'
+    store_path.mkdir()
+    cell = CompactCell('MAPPED', store_path=str(store_path))
+    cell.add_to_layer(1, SQUARE, CIRCLE)
+    reference = Cell('MAPPED')
+    reference.add_to_layer(1, SQUARE, CIRCLE)
+
+    reference.save(str(tmp_path / 'reference.gds'))
+    save_gds(cell, str(tmp_path / 'serial.gds'))
+    save_gds(cell, str(tmp_path / 'parallel.gds'), parallel=True)
+
+    assert diff_gds(str(tmp_path / 'reference.gds'), str(tmp_path / 'serial.gds')) == []
+    assert diff_gds(str(tmp_path / 'reference.gds'), str(tmp_path / 'parallel.gds')) == []
+
+
+def test_save_rescales_to_grid(tmp_path):
+    cell = CompactCell('RESCALED')
+    cell.add_to_layer(1, SQUARE, CIRCLE)
+    save_gds(cell, str(tmp_path / 'fine.gds'), grid_steps_per_micron=2000)
+
+    cells, unit = read_gds(str(tmp_path / 'fine.gds'))
+    assert np.isclose(unit, 1 / 2000)
+    assert normalised(cells['RESCALED']['polygons'][(1, 1)]) == \
+        normalised([2 * xy for xy in cell.layer_dict[1][0]])
+
+
+def test_lower_max_points_fractures_again(tmp_path):
+    cell = CompactCell('FRACTURED')
+    cell.add_to_layer(1, Point(0, 0).buffer(10, 900))
+    assert len(cell.layer_dict[1][0]) == 1
+
+    polygons = list(cell.get_fractured_layer_dict(max_points=500, max_line_points=500)[1])
+    assert len(polygons) > 1
+    assert all(len(polygon.exterior.coords) <= 500 for polygon in polygons)
+
+    save_gds(cell, str(tmp_path / 'fractured.gds'), max_points=500)
+    cells, unit = read_gds(str(tmp_path / 'fractured.gds'))
+    assert all(len(xy) <= 501 for xy in cells['FRACTURED']['polygons'][(1, 1)])
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from parameters import GRID_STEPS_PER_MICRON
+from variants import sample_parameters, generate_variants, VARIANT_LENGTHS
+
+NOMINAL = {'gap': 1, 'radius': 20, 'grating_ff': 0.5}
+
+
+def test_same_seed_gives_same_samples():
+    assert sample_parameters(NOMINAL, n=20, seed=7) == sample_parameters(NOMINAL, n=20, seed=7)
+    assert sample_parameters(NOMINAL, n=20, seed=7) != sample_parameters(NOMINAL, n=20, seed=8)
+
+
+def test_corners_start_with_nominal():
+    samples = sample_parameters(NOMINAL, mode='corner')
+
+    assert len(samples) == 1 + 2 ** len(NOMINAL)
+    assert samples[0] == NOMINAL
+    assert len({tuple(sorted(sample.items())) for sample in samples}) == len(samples)
+
+
+def test_only_lengths_are_snapped_to_grid():
+    samples = sample_parameters(NOMINAL, n=50)
+
+    for key in VARIANT_LENGTHS:
+        values = np.array([sample[key] for sample in samples if key in sample]) * GRID_STEPS_PER_MICRON
+        assert np.allclose(values, np.round(values))
+    grating_ff = np.array([sample['grating_ff'] for sample in samples]) * GRID_STEPS_PER_MICRON
+    assert not np.allclose(grating_ff, np.round(grating_ff))
+
+
+def test_generate_variants():
+    cells, samples = generate_variants('ring', {'gap': 1, 'radius': 20}, n=3, name='RING20')
+
+    assert [cell.name for cell in cells] == ['RING20_VAR_0', 'RING20_VAR_1', 'RING20_VAR_2']
+    assert samples == sample_parameters({'gap': 1, 'radius': 20}, n=3)
+
+
+def test_unknown_mode_or_device():
+    with pytest.raises(ValueError):
+        sample_parameters(NOMINAL, mode='latin_hypercube')
+    with pytest.raises(ValueError):
+        generate_variants('spiral', {'num': 5})
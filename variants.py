@@ -0,0 +1,255 @@
+import itertools
+import numpy as np
+from math import pi
+from gdshelpers.parts.interferometer import MachZehnderInterferometerMMI
+from gdshelpers.parts.resonator import RingResonator
+
+from components import *
+from parameters import *
+from polygon_store import CompactCell
+
+# Shared sub-geometry (couplers and routing) is built once and then only
+# referenced by each variant, so a variant costs one perturbed primitive.
+_COUPLER_CACHE = {}
+_ROUTE_CACHE = {}
+
+# Never reset, so cached cells built after clear_variant_cache() keep unique names
+ROUTE_IDENTIFIER = 0
+
+
+def clear_variant_cache():
+    """
+    Forget all cached couplers and routing cells.
+    """
+    _COUPLER_CACHE.clear()
+    _ROUTE_CACHE.clear()
+
+
+def _round_to_grid(value):
+    """
+    Snap a length in um onto the database-unit grid used when saving.
+    """
+    return float(np.round(value * GRID_STEPS_PER_MICRON) / GRID_STEPS_PER_MICRON)
+
+
+def _port_key(port):
+    """
+    Hashable description of a port, on the database-unit grid.
+    """
+    return (_round_to_grid(port.origin[0]), _round_to_grid(port.origin[1]),
+            round(float(port.angle), 9), _round_to_grid(port.width))
+
+
+def origin_coupler(coupler_params):
+    """
+    Returns a Cornerstone grating coupler built at the origin, facing the
+    same way as the left gratings of grating_loopback.
+    :param coupler_params: dict of specs for coupler, an angle is ignored
+    :return: CornerstoneGratingCoupler
+    """
+    params = {key: value for key, value in coupler_params.items() if key != 'angle'}
+    return CornerstoneGratingCoupler().create_coupler(origin=(0, 0), coupler_params=params)
+
+
+def cached_coupler(coupler_params):
+    """
+    Same as origin_coupler, but the coupler is only built the first
+    time a given set of coupler parameters is seen.
+    :param coupler_params: dict of specs for coupler
+    :return: CornerstoneGratingCoupler
+    """
+    key = tuple(sorted((key, value) for key, value in coupler_params.items() if key != 'angle'))
+    if key not in _COUPLER_CACHE:
+        _COUPLER_CACHE[key] = origin_coupler(coupler_params)
+    return _COUPLER_CACHE[key]
+
+
+def add_coupler_at_port(cell, coupler, port):
+    """
+    Reference a cached coupler so that it terminates `port`, equivalent to
+    CornerstoneGratingCoupler.create_cornerstone_coupler_at_port.
+    :param cell: Cell the coupler is added to
+    :param coupler: Coupler from cached_coupler
+    :param port: Port the coupler is attached to
+    """
+    # Cached couplers are built with the default angle of -pi/2
+    cell.add_cell(coupler.cell, origin=tuple(port.origin), angle=port.angle + pi / 2)
+
+
+def cached_route(key, build_route):
+    """
+    Returns a cell holding a routing waveguide, building it only the
+    first time `key` is seen.
+    :param key: Hashable which uniquely describes the routing
+    :param build_route: Function returning the Waveguide, optionally followed by further ports
+    :return: cell, followed by what build_route returned
+    """
+    global ROUTE_IDENTIFIER
+    if key not in _ROUTE_CACHE:
+        route = build_route()
+        route = route if isinstance(route, tuple) else (route,)
+        cell = CompactCell("ROUTE_{}_{}".format(key[0], ROUTE_IDENTIFIER))
+        ROUTE_IDENTIFIER += 1
+        cell.add_to_layer(WAVEGUIDE_LAYER, route[0])
+        _ROUTE_CACHE[key] = (cell,) + route
+    return _ROUTE_CACHE[key]
+
+
+def ring_variant(name, gap=1, radius=20, coupler_params=coupler_parameters):
+    """
+    Ring resonator device between two gratings. Only the ring is built,
+    couplers and bus waveguide come from the cache.
+    :param name: String which uniquely identifies the cell
+    :param gap: Gap between bus waveguide and ring
+    :param radius: Ring radius
+    :param coupler_params: dict of specs for coupler
+    :return: Cell containing the device
+    """
+    coupler = cached_coupler(coupler_params)
+    route_cell, bus, ring_port = cached_route(('ring', _port_key(coupler.port)),
+                                              lambda: ring_bus_waveguide(coupler.port))
+
+    cell = CompactCell(name)
+    cell.add_cell(coupler.cell)
+    cell.add_cell(route_cell)
+    add_coupler_at_port(cell, coupler, bus.current_port)
+    cell.add_to_layer(WAVEGUIDE_LAYER, RingResonator.make_at_port(ring_port, gap=gap, radius=radius))
+
+    return cell
+
+
+def mzi_variant(name, upper_vertical_length=50, coupler_params=coupler_parameters):
+    """
+    MZI device between two gratings. Only the MZI is built, couplers and
+    routing come from the cache.
+    :param name: String which uniquely identifies the cell
+    :param upper_vertical_length: Vertical length of the upper MZI arm
+    :param coupler_params: dict of specs for coupler
+    :return: Cell containing the device
+    """
+    coupler = cached_coupler(coupler_params)
+    input_cell, input_wg = cached_route(('mzi_in', _port_key(coupler.port)),
+                                        lambda: mzi_input_waveguide(coupler.port))
+    mzi = MachZehnderInterferometerMMI.make_at_port(port=input_wg.current_port, splitter_length=33, splitter_width=7,
+                                                    bend_radius=20, upper_vertical_length=upper_vertical_length,
+                                                    lower_vertical_length=100,
+                                                    horizontal_length=30)
+    # The output routing is keyed on where the MZI ends, should the perturbation move it
+    output_cell, output_wg = cached_route(('mzi_out', _port_key(mzi.port)),
+                                          lambda: mzi_output_waveguide(mzi.port))
+
+    cell = CompactCell(name)
+    cell.add_cell(coupler.cell)
+    cell.add_cell(input_cell)
+    cell.add_cell(output_cell)
+    add_coupler_at_port(cell, coupler, output_wg.current_port)
+    cell.add_to_layer(WAVEGUIDE_LAYER, mzi)
+
+    return cell
+
+
+def grating_variant(name, grating_ff=GRATING_FILL_FACTOR, coupler_params=coupler_parameters):
+    """
+    Grating loopback with a perturbed fill factor. Only the coupler is
+    built, the loopback waveguide comes from the cache. Perturbed couplers
+    are not cached, as every sample has its own fill factor.
+    :param name: String which uniquely identifies the cell
+    :param grating_ff: Fill factor of both gratings
+    :param coupler_params: dict of specs for coupler, grating_ff is overwritten
+    :return: Cell containing the device
+    """
+    if grating_ff == coupler_params['grating_ff']:
+        coupler = cached_coupler(coupler_params)
+    else:
+        coupler = origin_coupler(dict(coupler_params, grating_ff=grating_ff))
+    route_cell, loopback = cached_route(('loopback', _port_key(coupler.port)),
+                                        lambda: loopback_waveguide(coupler.port, length=127 - 10 - 10))
+
+    cell = CompactCell(name)
+    cell.add_cell(coupler.cell)
+    cell.add_cell(route_cell)
+    add_coupler_at_port(cell, coupler, loopback.current_port)
+
+    return cell
+
+
+VARIANT_BUILDERS = {
+    'ring': ring_variant,
+    'mzi': mzi_variant,
+    'grating': grating_variant
+}
+
+VARIANT_SIGMAS = {
+    'gap': GAP_SIGMA,
+    'radius': RADIUS_SIGMA,
+    'upper_vertical_length': UPPER_VERTICAL_LENGTH_SIGMA,
+    'grating_ff': GRATING_FF_SIGMA
+}
+
+# Parameters which are lengths in um, only these are snapped onto the grid
+VARIANT_LENGTHS = ('gap', 'radius', 'upper_vertical_length')
+
+
+def sample_parameters(nominal, sigma=None, n=1, seed=VARIANT_SEED, mode='monte_carlo'):
+    """
+    Draw perturbed parameter sets around a nominal design.
+
+    In 'monte_carlo' mode each parameter is drawn from a normal distribution
+    around its nominal value, giving n samples. In 'corner' mode the nominal
+    design is followed by every combination of nominal +/- CORNER_SIGMAS * sigma,
+    n is ignored. Lengths are snapped onto the database-unit grid.
+    :param nominal: dict of parameter name to nominal value
+    :param sigma: dict of parameter name to standard deviation, defaults to VARIANT_SIGMAS
+    :param n: Number of Monte-Carlo samples
+    :param seed: Seed of the random generator, the same seed gives the same samples
+    :param mode: 'monte_carlo' or 'corner'
+    :return: list of dicts of parameters
+    """
+    if sigma is None:
+        sigma = VARIANT_SIGMAS
+    names = sorted(nominal)
+    sigmas = np.array([sigma.get(key, 0) for key in names], dtype=float)
+    centre = np.array([nominal[key] for key in names], dtype=float)
+
+    if mode == 'monte_carlo':
+        rng = np.random.default_rng(seed)
+        values = rng.normal(centre, sigmas, size=(n, len(names)))
+    elif mode == 'corner':
+        spread = CORNER_SIGMAS * sigmas
+        corners = itertools.product(*[sorted({c - s, c + s}) for c, s in zip(centre, spread)])
+        values = np.vstack([centre] + [np.array(corner) for corner in corners])
+    else:
+        raise ValueError("Unknown variant mode '{}', use 'monte_carlo' or 'corner'".format(mode))
+
+    return [{key: _round_to_grid(value) if key in VARIANT_LENGTHS else float(value) for key, value in zip(names, row)}
+            for row in values]
+
+
+def generate_variants(device, nominal, n=1, sigma=None, seed=VARIANT_SEED, mode='monte_carlo', name=None,
+                      coupler_params=coupler_parameters):
+    """
+    Expand a base device into perturbed instances.
+
+    Example: 500 variants of the 20um ring
+    generate_variants('ring', {'gap': 1, 'radius': 20}, n=500, name='RING20')
+    :param device: One of 'ring', 'mzi' or 'grating'
+    :param nominal: dict of nominal parameters passed to the device builder
+    :param n: Number of Monte-Carlo samples
+    :param sigma: dict of standard deviations, defaults to VARIANT_SIGMAS
+    :param seed: Seed of the random generator
+    :param mode: 'monte_carlo' or 'corner'
+    :param name: Prefix of the cell names, defaults to the device upper-cased
+    :param coupler_params: dict of specs for coupler
+    :return: list of cells, list of the parameters of each cell
+    """
+    if device not in VARIANT_BUILDERS:
+        raise ValueError("Unknown device '{}', use one of {}".format(device, sorted(VARIANT_BUILDERS)))
+    builder = VARIANT_BUILDERS[device]
+    name = name or device.upper()
+
+    samples = sample_parameters(nominal, sigma, n=n, seed=seed, mode=mode)
+    cells = [builder('{}_VAR_{}'.format(name, i), coupler_params=coupler_params, **params)
+             for i, params in enumerate(samples)]
+
+    return cells, samples
+